@@ -0,0 +1,131 @@
+"""
+Token verification on top of the Auth model.
+
+Tokens are resolved through the indexed 'auth.token_digest' column and the
+result is kept in a bounded, per-process cache so that validating the token
+of every API request does not hit the database. Cached entries expire after
+'ttl' seconds and are dropped when a transaction that updates or deletes the
+Auth row of their user commits through this process' sessions; other
+processes pick up revocations when the entry expires.
+
+Bulk operations (Query.update(), Query.delete() or plain SQL) do not go
+through the session's unit of work and are not noticed: call invalidate()
+on the verifiers after running them.
+"""
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app import db
+from .models import Auth
+import threading
+import time
+import weakref
+
+_verifiers = weakref.WeakSet()
+_PENDING_USERS = 'landportal_auth_invalidated_users'
+
+
+class TokenVerifier(object):
+    """Resolves API tokens to user ids, caching the verified digests
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache = OrderedDict()  # digest -> (user, expiration time)
+        self._generation = 0  # bumped by every invalidation
+        self._lock = threading.Lock()
+        _verifiers.add(self)
+
+    def verify(self, token):
+        """Returns the user owning 'token', or None if the token is not valid.
+
+        Only digests are compared, through the database index, so the time
+        taken by a lookup tells nothing about the raw token
+        """
+        if not token:
+            return None
+        digest = Auth.digest(token)
+        user = self._get_cached(digest)
+        if user is not None:
+            return user
+        generation = self._generation
+        auth = Auth.query.filter_by(token_digest=digest).first()
+        if auth is None:
+            return None
+        self._put_cached(digest, auth.user, generation)
+        return auth.user
+
+    def invalidate(self, user=None):
+        """Drops the cached tokens of 'user', or the whole cache if no user
+        is given
+        """
+        with self._lock:
+            self._generation += 1
+            if user is None:
+                self._cache.clear()
+                return
+            for digest in [d for d, (u, _) in self._cache.items() if u == user]:
+                del self._cache[digest]
+
+    def _get_cached(self, digest):
+        with self._lock:
+            entry = self._cache.get(digest)
+            if entry is None:
+                return None
+            user, expiration = entry
+            if expiration <= time.time():
+                del self._cache[digest]
+                return None
+            return user
+
+    def _put_cached(self, digest, user, generation):
+        with self._lock:
+            # An invalidation happened while the row was being read, which
+            # may then be the revoked one
+            if generation != self._generation:
+                return
+            self._cache.pop(digest, None)
+            self._cache[digest] = (user, time.time() + self.ttl)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+
+def backfill_token_digests():
+    """Computes the digest of the Auth rows that still hold a plaintext
+    token and clears the token. Must run once before TokenVerifier is used
+    on a database created without 'token_digest'. Returns the number of
+    migrated rows
+    """
+    auth = Auth.__table__
+    rows = db.session.query(auth.c.user, auth.c.token).filter(auth.c.token != None).all()
+    for user, token in rows:
+        db.session.execute(auth.update().where(auth.c.user == user)
+                           .values(token_digest=Auth.digest(token), token=None))
+    db.session.commit()
+    for verifier in list(_verifiers):
+        verifier.invalidate()
+    return len(rows)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_users(session, flush_context):
+    users = session.info.setdefault(_PENDING_USERS, set())
+    for instance in list(session.dirty) + list(session.deleted):
+        if isinstance(instance, Auth):
+            users.add(instance.user)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_verifiers(session):
+    users = session.info.pop(_PENDING_USERS, None)
+    if not users:
+        return
+    for verifier in list(_verifiers):
+        for user in users:
+            verifier.invalidate(user)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed_users(session):
+    session.info.pop(_PENDING_USERS, None)
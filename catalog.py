@@ -0,0 +1,202 @@
+"""
+Precomputed catalog of Organization -> DataSource -> Dataset -> Indicator.
+
+The whole graph, with the translations of one language, is loaded in a
+fixed number of bulk queries, inside a single transaction, and frozen into
+a CatalogSnapshot made of namedtuples. The version and ETag of a snapshot
+are a hash of its contents (indicators included, with their last_update),
+so they change with any part of the catalog, and snapshots can be served
+from memory answering conditional requests. CatalogCache keeps one snapshot
+per language and rebuilds them, optionally in a background thread, once an
+ingestion has finished.
+"""
+from collections import namedtuple
+from sqlalchemy.orm import Session
+from app import db
+from .models import Organization, OrganizationTranslation, DataSource, Dataset, \
+    Indicator, IndicatorTranslation, dataset_indicator
+import hashlib
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Isolation levels under which every query of a build sees the same data.
+# Other databases (such as SQLite) already serialize transactions
+SNAPSHOT_ISOLATION_LEVELS = {
+    'postgresql': 'REPEATABLE READ',
+    'mysql': 'REPEATABLE READ',
+}
+
+CatalogOrganization = namedtuple('CatalogOrganization',
+                                 'id name url is_part_of_id description sources')
+CatalogDataSource = namedtuple('CatalogDataSource', 'id name datasets')
+CatalogDataset = namedtuple('CatalogDataset', 'id sdmx_frequency license_id indicators')
+CatalogIndicator = namedtuple('CatalogIndicator',
+                              'id name description preferable_tendency measurement_unit_id '
+                              'topic_id starred last_update')
+
+
+class CatalogSnapshot(object):
+    """Immutable catalog of a single language. Data sources without an
+    organization and datasets without a data source are kept apart in
+    'unassigned_sources' and 'unassigned_datasets'
+    """
+
+    def __init__(self, lang_code, organizations, unassigned_sources=(), unassigned_datasets=()):
+        self.lang_code = lang_code
+        self.organizations = tuple(organizations)
+        self.unassigned_sources = tuple(unassigned_sources)
+        self.unassigned_datasets = tuple(unassigned_datasets)
+        content = json.dumps(self._content(), sort_keys=True).encode('utf-8')
+        self.version = hashlib.sha1(content).hexdigest()
+        self.etag = '"%s"' % self.version
+
+    def matches(self, if_none_match):
+        """Tells whether an If-None-Match header value refers to this
+        snapshot, in which case a 304 response can be sent
+        """
+        if not if_none_match:
+            return False
+        etags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in etags or self.etag in etags or ('W/' + self.etag) in etags
+
+    def to_dict(self):
+        content = self._content()
+        content['version'] = self.version
+        return content
+
+    def _content(self):
+        return {
+            'lang_code': self.lang_code,
+            'organizations': _to_dict(self.organizations),
+            'unassigned_sources': _to_dict(self.unassigned_sources),
+            'unassigned_datasets': _to_dict(self.unassigned_datasets),
+        }
+
+
+def _to_dict(item):
+    if isinstance(item, tuple) and hasattr(item, '_asdict'):
+        return dict((key, _to_dict(value)) for key, value in item._asdict().items())
+    if isinstance(item, tuple):
+        return [_to_dict(value) for value in item]
+    if hasattr(item, 'isoformat'):
+        return item.isoformat()
+    return item
+
+
+def build_snapshot(lang_code):
+    """Builds the CatalogSnapshot of 'lang_code' in a few bulk queries run
+    in one transaction
+    """
+    with db.engine.connect() as connection:
+        isolation_level = SNAPSHOT_ISOLATION_LEVELS.get(connection.dialect.name)
+        if isolation_level is not None:
+            connection = connection.execution_options(isolation_level=isolation_level)
+        with connection.begin():
+            session = Session(bind=connection)
+            try:
+                return _load_snapshot(session, lang_code)
+            finally:
+                session.close()
+
+
+def _load_snapshot(session, lang_code):
+    indicator_translations = dict(
+        (indicator_id, (name, description)) for indicator_id, name, description in
+        session.query(IndicatorTranslation.indicator_id, IndicatorTranslation.name,
+                      IndicatorTranslation.description)
+        .filter(IndicatorTranslation.lang_code == lang_code))
+    indicators = {}
+    for row in session.query(Indicator.id, Indicator.preferable_tendency,
+                             Indicator.measurement_unit_id, Indicator.topic_id,
+                             Indicator.starred, Indicator.last_update):
+        name, description = indicator_translations.get(row.id, (None, None))
+        indicators[row.id] = CatalogIndicator(row.id, name, description, row.preferable_tendency,
+                                              row.measurement_unit_id, row.topic_id,
+                                              row.starred, row.last_update)
+
+    dataset_indicators = {}
+    for dataset_id, indicator_id in session.query(dataset_indicator.c.dataset_id,
+                                                  dataset_indicator.c.indicator_id):
+        if indicator_id in indicators:
+            dataset_indicators.setdefault(dataset_id, []).append(indicators[indicator_id])
+
+    source_datasets = {}
+    for row in session.query(Dataset.id, Dataset.sdmx_frequency, Dataset.license_id,
+                             Dataset.datasource_id).order_by(Dataset.id):
+        indicator_list = sorted(dataset_indicators.get(row.id, []), key=lambda i: i.id)
+        source_datasets.setdefault(row.datasource_id, []).append(
+            CatalogDataset(row.id, row.sdmx_frequency, row.license_id, tuple(indicator_list)))
+
+    organization_sources = {}
+    for row in session.query(DataSource.id, DataSource.name,
+                             DataSource.organization_id).order_by(DataSource.id):
+        organization_sources.setdefault(row.organization_id, []).append(
+            CatalogDataSource(row.id, row.name, tuple(source_datasets.get(row.id, []))))
+
+    organization_descriptions = dict(
+        session.query(OrganizationTranslation.organization_id,
+                      OrganizationTranslation.description)
+        .filter(OrganizationTranslation.lang_code == lang_code))
+    organizations = [
+        CatalogOrganization(row.id, row.name, row.url, row.is_part_of_id,
+                            organization_descriptions.get(row.id),
+                            tuple(organization_sources.get(row.id, [])))
+        for row in session.query(Organization.id, Organization.name, Organization.url,
+                                 Organization.is_part_of_id).order_by(Organization.id)]
+
+    return CatalogSnapshot(lang_code, organizations,
+                           organization_sources.get(None, []), source_datasets.get(None, []))
+
+
+class CatalogCache(object):
+    """Keeps a CatalogSnapshot per language in memory. 'app' is the Flask
+    application whose context background rebuilds run in. Builds are
+    serialized, so a snapshot never replaces one built after it
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self._snapshots = {}
+        self._build_lock = threading.Lock()
+
+    def get(self, lang_code):
+        """Returns the snapshot of 'lang_code', building it on first use
+        """
+        snapshot = self._snapshots.get(lang_code)
+        if snapshot is None:
+            with self._build_lock:
+                snapshot = self._snapshots.get(lang_code)
+                if snapshot is None:
+                    snapshot = build_snapshot(lang_code)
+                    self._snapshots[lang_code] = snapshot
+        return snapshot
+
+    def refresh(self):
+        """Rebuilds the snapshots of every cached language. Meant to be
+        called after an ingestion; snapshots whose contents did not change
+        keep their ETag
+        """
+        with self._build_lock:
+            for lang_code in list(self._snapshots):
+                self._snapshots[lang_code] = build_snapshot(lang_code)
+
+    def refresh_async(self):
+        """Runs refresh() in a background thread. Snapshots keep being
+        served from memory until their replacement is ready
+        """
+        if self.app is None:
+            raise ValueError('CatalogCache needs an app to refresh in the background')
+        thread = threading.Thread(target=self._refresh_in_context)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _refresh_in_context(self):
+        with self.app.app_context():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Could not rebuild the catalog snapshots')
@@ -0,0 +1,263 @@
+"""
+Binary observation cube for offline analytics.
+
+export_cube() writes every yearly observation to a single file made of a
+fixed header, the dictionary tables (indicator ids, region ids and ISO3
+codes, years and the indicators contributed by each dataset) as JSON, and
+an indicator x region x year float64 array. Missing observations are NaN.
+Worker processes open it with ObservationCube.open(), which memory-maps the
+array, so slicing by indicator or country neither copies the data nor
+touches the database.
+
+update_cube() refreshes the indicators of some datasets from the database
+and copies the rest from the previous cube. Files are always written to a
+temporary file and renamed, so readers keep their mapping of the old file.
+The header checksum covers the whole file, with the checksum field zeroed.
+"""
+from sqlalchemy import or_
+from app import db
+from .models import Observation, Value, YearInterval, Country
+import json
+import os
+import struct
+import tempfile
+import zlib
+import numpy as np
+
+MAGIC = b'LPCUBE\x00\x00'
+FORMAT_VERSION = 1
+# magic, format version, reserved, checksum, cube version, tables offset, tables length,
+# data offset, number of indicators, regions and years
+HEADER = struct.Struct('<8sHHIQQQQIII')
+CHECKSUM_FIELD = slice(12, 16)
+ALIGNMENT = 64
+DTYPE = np.dtype('<f8')
+
+
+class CubeFormatError(Exception):
+    pass
+
+
+class ObservationCube(object):
+    """Read-only view over a cube file
+    """
+
+    def __init__(self, path, version, indicators, regions, periods, datasets, data):
+        self.path = path
+        self.version = version
+        self.indicators = indicators
+        self.regions = regions
+        self.periods = periods
+        self.datasets = datasets
+        self.data = data
+        self._indicator_index = dict((indicator_id, i) for i, indicator_id in enumerate(indicators))
+        self._region_index = dict((region_id, i) for i, (region_id, _) in enumerate(regions))
+        self._iso3_index = dict((iso3, i) for i, (_, iso3) in enumerate(regions) if iso3)
+        self._period_index = dict((year, i) for i, year in enumerate(periods))
+
+    @classmethod
+    def open(cls, path, verify=False):
+        """Maps the cube at 'path'. With 'verify' the whole file is read
+        once to check its checksum
+        """
+        with open(path, 'rb') as cube_file:
+            header = cube_file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise CubeFormatError('%s is too short to be a cube' % path)
+            magic, format_version, _, checksum, version, tables_offset, tables_length, \
+                data_offset, n_indicators, n_regions, n_periods = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise CubeFormatError('%s is not a cube' % path)
+            if format_version != FORMAT_VERSION:
+                raise CubeFormatError('Unsupported cube format version %d' % format_version)
+            if verify:
+                chunks = [_zero_checksum(header)]
+                chunks.extend(iter(lambda: cube_file.read(1 << 20), b''))
+                if _checksum(chunks) != checksum:
+                    raise CubeFormatError('Checksum mismatch in %s' % path)
+            cube_file.seek(tables_offset)
+            tables = json.loads(cube_file.read(tables_length).decode('utf-8'))
+        shape = (n_indicators, n_regions, n_periods)
+        if 0 in shape:
+            data = np.full(shape, np.nan, dtype=DTYPE)
+        else:
+            data = np.memmap(path, dtype=DTYPE, mode='r', offset=data_offset, shape=shape)
+        return cls(path, version, tables['indicators'],
+                   [tuple(region) for region in tables['regions']],
+                   tables['periods'], tables['datasets'], data)
+
+    def indicator(self, indicator_id):
+        """Region x year view of an indicator"""
+        return self.data[self._indicator_index[indicator_id]]
+
+    def region(self, region_id):
+        """Indicator x year view of a region"""
+        return self.data[:, self._region_index[region_id], :]
+
+    def country(self, iso3):
+        """Indicator x year view of a country"""
+        return self.data[:, self._iso3_index[iso3], :]
+
+    def value(self, indicator_id, region_id, year):
+        """Returns the observed value, or NaN if there is none"""
+        return float(self.data[self._indicator_index[indicator_id],
+                               self._region_index[region_id],
+                               self._period_index[year]])
+
+
+def export_cube(path):
+    """Writes every yearly observation to a new cube at 'path'
+    """
+    observations = _load_observations()
+    cube = _build(observations, _dataset_indicators(observations))
+    _write(path, 1, *cube)
+
+
+def update_cube(path, dataset_ids):
+    """Refreshes the indicators of 'dataset_ids' in the cube at 'path'.
+    Indicators of other datasets are copied from the current cube
+    """
+    old = ObservationCube.open(path)
+    dataset_ids = set(dataset_ids)
+    affected = set()
+    for dataset_id in dataset_ids:
+        affected.update(old.datasets.get(dataset_id, []))
+    observations = _load_observations(Observation.dataset_id.in_(dataset_ids))
+    affected.update(row[0] for row in observations)
+    if affected:
+        observations += _load_observations(Observation.indicator_id.in_(affected),
+                                           or_(Observation.dataset_id.is_(None),
+                                               ~Observation.dataset_id.in_(dataset_ids)))
+        # Same order as a full export, so that duplicated cells resolve alike
+        observations.sort(key=lambda row: row[6])
+
+    datasets = dict((dataset_id, indicators) for dataset_id, indicators in old.datasets.items()
+                    if dataset_id not in dataset_ids)
+    for dataset_id, indicators in _dataset_indicators(observations).items():
+        datasets[dataset_id] = sorted(set(datasets.get(dataset_id, [])) | set(indicators))
+
+    kept = [indicator_id for indicator_id in old.indicators if indicator_id not in affected]
+    indicators, regions, periods, datasets, data = _build(observations, datasets,
+                                                          kept, old.regions, old.periods)
+    if kept:
+        indicator_index = dict((indicator_id, i) for i, indicator_id in enumerate(indicators))
+        region_index = dict((region_id, i) for i, (region_id, _) in enumerate(regions))
+        period_index = dict((year, i) for i, year in enumerate(periods))
+        region_cols = [region_index[region_id] for region_id, _ in old.regions]
+        period_cols = [period_index[year] for year in old.periods]
+        cells = np.ix_(region_cols, period_cols)
+        # One indicator at a time, not to load the whole old cube in memory
+        for indicator_id in kept:
+            data[indicator_index[indicator_id]][cells] = \
+                old.data[old._indicator_index[indicator_id]]
+    version = old.version + 1
+    del old
+    _write(path, version, indicators, regions, periods, datasets, data)
+
+
+def _load_observations(*criteria):
+    """Returns (indicator id, region id, iso3, year, value, dataset id,
+    observation id) tuples of the numeric yearly observations matching
+    'criteria', ordered by observation id
+    """
+    year_intervals = YearInterval.__table__
+    countries = Country.__table__
+    query = db.session.query(Observation.indicator_id, Observation.region_id, countries.c.iso3,
+                             year_intervals.c.year, Value.value, Observation.dataset_id,
+                             Observation.id)\
+        .join(Value, Observation.value_id == Value.id)\
+        .join(year_intervals, Observation.ref_time_id == year_intervals.c.id)\
+        .outerjoin(countries, Observation.region_id == countries.c.id)\
+        .filter(Observation.region_id != None)
+    for criterion in criteria:
+        query = query.filter(criterion)
+    observations = []
+    for indicator_id, region_id, iso3, year, value, dataset_id, id in \
+            query.order_by(Observation.id):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            continue
+        observations.append((indicator_id, region_id, iso3, year, value, dataset_id, id))
+    return observations
+
+
+def _dataset_indicators(observations):
+    datasets = {}
+    for indicator_id, _, _, _, _, dataset_id, _ in observations:
+        if dataset_id is not None:
+            datasets.setdefault(dataset_id, set()).add(indicator_id)
+    return dict((dataset_id, sorted(indicators)) for dataset_id, indicators in datasets.items())
+
+
+def _build(observations, datasets, indicators=(), regions=(), periods=()):
+    """Dictionary-encodes 'observations' on top of the given axes and
+    returns the axes, the dataset table and the NaN-filled array. Regions
+    are (id, ISO3) pairs; the ISO3 code read from 'observations' wins. When
+    several observations fall in the same cell, the last one wins
+    """
+    indicators = sorted(set(indicators) | set(row[0] for row in observations))
+    iso3_codes = dict(regions)
+    iso3_codes.update((row[1], row[2]) for row in observations)
+    regions = sorted(iso3_codes.items())
+    periods = sorted(set(periods) | set(row[3] for row in observations))
+    indicator_index = dict((indicator_id, i) for i, indicator_id in enumerate(indicators))
+    region_index = dict((region_id, i) for i, (region_id, _) in enumerate(regions))
+    period_index = dict((year, i) for i, year in enumerate(periods))
+
+    data = np.full((len(indicators), len(regions), len(periods)), np.nan, dtype=DTYPE)
+    cells = dict(((indicator_index[row[0]], region_index[row[1]], period_index[row[3]]), row[4])
+                 for row in observations)
+    if cells:
+        rows, cols, years = np.array(list(cells.keys())).T
+        data[rows, cols, years] = list(cells.values())
+    return indicators, regions, periods, datasets, data
+
+
+def _zero_checksum(header):
+    header = bytearray(header)
+    header[CHECKSUM_FIELD] = b'\x00' * 4
+    return bytes(header)
+
+
+def _checksum(chunks):
+    checksum = 0
+    for chunk in chunks:
+        checksum = zlib.crc32(chunk, checksum)
+    return checksum & 0xffffffff
+
+
+def _write(path, version, indicators, regions, periods, datasets, data):
+    tables = json.dumps({
+        'indicators': indicators,
+        'regions': [list(region) for region in regions],
+        'periods': periods,
+        'datasets': datasets,
+    }, sort_keys=True).encode('utf-8')
+    tables_offset = HEADER.size
+    data_offset = -(-(tables_offset + len(tables)) // ALIGNMENT) * ALIGNMENT
+    padding = b'\x00' * (data_offset - tables_offset - len(tables))
+    # A view on the array, neither copied nor serialized in memory
+    payload = memoryview(np.ascontiguousarray(data, dtype=DTYPE)).cast('B')
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, 0, version, tables_offset,
+                         len(tables), data_offset, len(indicators), len(regions), len(periods))
+    checksum = _checksum([header, tables, padding, payload])
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, checksum, version, tables_offset,
+                         len(tables), data_offset, len(indicators), len(regions), len(periods))
+
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                             suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as cube_file:
+            cube_file.write(header)
+            cube_file.write(tables)
+            cube_file.write(padding)
+            cube_file.write(payload)
+            cube_file.flush()
+            os.fsync(cube_file.fileno())
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -3,12 +3,13 @@ Created on 03/02/2014
 
 @author: Herminio
 """
-from sqlalchemy.sql.schema import Column, ForeignKey
+from sqlalchemy.sql.schema import Column, ForeignKey, Index
 from sqlalchemy.sql.sqltypes import Integer, String, TIMESTAMP, BOOLEAN, DATE, Float
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, validates
 from abc import abstractmethod
 from app import db
 import datetime
+import hashlib
 
 # Only for many-to-many relationship between Dataset and Indicator
 dataset_indicator = db.Table('dataset_indicator',
@@ -726,11 +727,83 @@ class CompoundIndicator(Indicator):
         return '<CompoundIndicator: id={}'.format(self.id)
 
 
+class IndicatorRanking(db.Model):
+    """Precomputed position of a country among all the countries with a
+    value for an indicator and year. Filled by the ranking stage.
+    Rank, percentile and z-score follow the indicator's preferable
+    tendency: rank 1, percentile 100 and positive z-scores are the best
+    """
+    __tablename__ = "indicatorRankings"
+    indicator_id = Column(String(255), ForeignKey("indicators.id"), primary_key=True)
+    year = Column(Integer, primary_key=True, autoincrement=False)
+    country_id = Column(Integer, ForeignKey("countries.id"), primary_key=True)
+    value = Column(Float)
+    rank = Column(Integer)
+    percentile = Column(Float)
+    z_score = Column(Float)
+
+    __table_args__ = (
+        Index('ix_indicatorRankings_indicator_year_rank', 'indicator_id', 'year', 'rank'),
+        Index('ix_indicatorRankings_country', 'country_id'),
+    )
+
+    def __init__(self, indicator_id, year, country_id, value=None, rank=None,
+                 percentile=None, z_score=None):
+        self.indicator_id = indicator_id
+        self.year = year
+        self.country_id = country_id
+        self.value = value
+        self.rank = rank
+        self.percentile = percentile
+        self.z_score = z_score
+
+
+class IndicatorRankingState(db.Model):
+    """Last ranking run of an indicator, kept even when it produced no
+    ranking rows. 'computed_from' is the Indicator.last_update it saw
+    """
+    __tablename__ = "indicatorRankingStates"
+    indicator_id = Column(String(255), ForeignKey("indicators.id"), primary_key=True)
+    computed_from = Column(TIMESTAMP)
+    computed_at = Column(TIMESTAMP)
+    rankings = Column(Integer)
+
+    def __init__(self, indicator_id, computed_from=None, computed_at=None, rankings=0):
+        self.indicator_id = indicator_id
+        self.computed_from = computed_from
+        self.computed_at = computed_at
+        self.rankings = rankings
+
+
 class Auth(db.Model):
+    """API token of a user. Only the SHA-256 digest of the token is stored,
+    in the indexed 'token_digest' column. 'token' is the legacy plaintext
+    column: assigning a token stores its digest, assigning None revokes it,
+    and the attribute itself always reads None, so tokens must be checked
+    with auth.TokenVerifier instead of comparing 'token'. Rows written
+    before are migrated by auth.backfill_token_digests()
+    """
     __tablename__ = "auth"
     user = Column(String(255), primary_key=True)
     token = Column(String(255))
+    token_digest = Column(String(64), index=True, unique=True)
 
     def __init__(self, user, token):
         self.user = user
         self.token = token
+
+    def revoke(self):
+        """Invalidates the current token of the user"""
+        self.token = None
+
+    @validates('token')
+    def _update_token_digest(self, key, token):
+        self.token_digest = Auth.digest(token) if token is not None else None
+        return None
+
+    @staticmethod
+    def digest(token):
+        """Returns the hex SHA-256 digest stored for 'token'"""
+        if not isinstance(token, bytes):
+            token = token.encode('utf-8')
+        return hashlib.sha256(token).hexdigest()
@@ -0,0 +1,171 @@
+"""
+Ranking stage, meant to run after ingestion.
+
+For every (indicator, year) the countries with a numeric value are ranked
+following Indicator.preferable_tendency, and their rank, percentile and
+z-score are stored in IndicatorRanking, so that ranking tables and country
+comparisons are plain indexed reads. Each run is recorded per indicator in
+IndicatorRankingState, and only indicators updated since their last run are
+recomputed. Indicators without a last_update cannot be compared and are
+recomputed on every run.
+"""
+from sqlalchemy import or_
+from app import db
+from .models import Observation, Value, YearInterval, Country, Indicator, \
+    IndicatorRanking, IndicatorRankingState
+import datetime
+import numpy as np
+
+BATCH_SIZE = 50
+
+
+def get_ranking(indicator_id, year, country_id):
+    """Returns the IndicatorRanking of a country, or None if it has no value
+    for that indicator and year
+    """
+    return db.session.get(IndicatorRanking, (indicator_id, year, country_id))
+
+
+def stale_indicators():
+    """Returns the ids of the indicators never ranked, updated since their
+    last ranking, or without a last_update
+    """
+    state = IndicatorRankingState
+    query = db.session.query(Indicator.id)\
+        .outerjoin(state, state.indicator_id == Indicator.id)\
+        .filter(or_(state.indicator_id.is_(None),
+                    Indicator.last_update.is_(None),
+                    state.computed_from.is_(None),
+                    Indicator.last_update > state.computed_from))
+    return [indicator_id for indicator_id, in query]
+
+
+def update_rankings(indicator_ids=None, batch_size=BATCH_SIZE):
+    """Recomputes the rankings of 'indicator_ids', or of the stale
+    indicators if none are given. Returns the number of rows written
+    """
+    if indicator_ids is None:
+        indicator_ids = stale_indicators()
+    indicator_ids = list(indicator_ids)
+    written = 0
+    for start in range(0, len(indicator_ids), batch_size):
+        written += _rank_batch(indicator_ids[start:start + batch_size])
+    db.session.commit()
+    return written
+
+
+def compute_rankings(indicator_pos, years, values, decreasing):
+    """Ranks 'values' within each (indicator, year) group.
+
+    'indicator_pos', 'years' and 'values' are parallel arrays, and
+    'decreasing' tells, for each indicator position, whether lower values
+    are better. Returns the ranks, percentiles and z-scores aligned with the
+    input. Ties share the best rank of their group ("1224" ranking); the
+    percentile is the share of the rest of the group ranked behind, and
+    z-scores are signed so that positive means better
+    """
+    indicator_pos = np.asarray(indicator_pos, dtype=np.int64)
+    years = np.asarray(years, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    # Ascending sort keys: values are negated where higher is better
+    directions = np.where(np.asarray(decreasing, dtype=bool), 1.0, -1.0)[indicator_pos]
+    sort_keys = values * directions
+
+    order = np.lexsort((sort_keys, years, indicator_pos))
+    s_indicators, s_years = indicator_pos[order], years[order]
+    s_values, s_keys = values[order], sort_keys[order]
+
+    index = np.arange(len(values))
+    group_starts = np.ones(len(values), dtype=bool)
+    group_starts[1:] = (s_indicators[1:] != s_indicators[:-1]) | (s_years[1:] != s_years[:-1])
+    tie_starts = group_starts.copy()
+    tie_starts[1:] |= s_keys[1:] != s_keys[:-1]
+    group_first = np.maximum.accumulate(np.where(group_starts, index, 0))
+    tie_first = np.maximum.accumulate(np.where(tie_starts, index, 0))
+    groups = np.cumsum(group_starts) - 1
+
+    ranks = tie_first - group_first + 1
+    counts = np.bincount(groups)
+    sizes = counts[groups]
+    percentiles = np.where(sizes > 1,
+                           100.0 * (sizes - ranks) / np.maximum(sizes - 1, 1), 100.0)
+    means = (np.bincount(groups, weights=s_values) / counts)[groups]
+    stds = np.sqrt((np.bincount(groups, weights=(s_values - means) ** 2) / counts)[groups])
+    z_scores = np.where(stds > 0, (means - s_values) / np.where(stds > 0, stds, 1.0), 0.0)
+    z_scores *= directions[order]
+
+    result = np.empty((3, len(values)))
+    result[:, order] = (ranks, percentiles, z_scores)
+    return result[0].astype(np.int64), result[1], result[2]
+
+
+def _decreasing(preferable_tendency):
+    """Tells whether lower values are better for a preferable_tendency"""
+    return preferable_tendency is not None and 'decreas' in preferable_tendency.lower()
+
+
+def _rank_batch(indicator_ids):
+    indicators = db.session.query(Indicator.id, Indicator.preferable_tendency,
+                                  Indicator.last_update)\
+        .filter(Indicator.id.in_(indicator_ids)).all()
+    if not indicators:
+        return 0
+    positions = dict((indicator.id, i) for i, indicator in enumerate(indicators))
+
+    year_intervals = YearInterval.__table__
+    countries = Country.__table__
+    rows = db.session.query(Observation.indicator_id, year_intervals.c.year,
+                            Observation.region_id, Value.value)\
+        .join(Value, Observation.value_id == Value.id)\
+        .join(year_intervals, Observation.ref_time_id == year_intervals.c.id)\
+        .join(countries, Observation.region_id == countries.c.id)\
+        .filter(Observation.indicator_id.in_(indicator_ids))\
+        .order_by(Observation.id)
+    # Duplicated (indicator, year, country) observations: the greatest id wins
+    observations = {}
+    for indicator_id, year, country_id, value in rows:
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            continue
+        if np.isfinite(value):
+            observations[(positions[indicator_id], year, country_id)] = value
+
+    ids = [indicator.id for indicator in indicators]
+    IndicatorRanking.query.filter(IndicatorRanking.indicator_id.in_(ids))\
+        .delete(synchronize_session=False)
+    IndicatorRankingState.query.filter(IndicatorRankingState.indicator_id.in_(ids))\
+        .delete(synchronize_session=False)
+
+    records = []
+    if observations:
+        keys = np.array(list(observations.keys()), dtype=np.int64)
+        values = np.array(list(observations.values()), dtype=np.float64)
+        ranks, percentiles, z_scores = compute_rankings(
+            keys[:, 0], keys[:, 1], values,
+            [_decreasing(indicator.preferable_tendency) for indicator in indicators])
+        records = [{
+            'indicator_id': ids[pos],
+            'year': year,
+            'country_id': country_id,
+            'value': value,
+            'rank': rank,
+            'percentile': percentile,
+            'z_score': z_score,
+        } for (pos, year, country_id), value, rank, percentile, z_score in zip(
+            keys.tolist(), values.tolist(), ranks.tolist(), percentiles.tolist(),
+            z_scores.tolist())]
+        db.session.execute(IndicatorRanking.__table__.insert(), records)
+
+    counts = dict((indicator_id, 0) for indicator_id in ids)
+    for record in records:
+        counts[record['indicator_id']] += 1
+    # computed_at is a naive TIMESTAMP holding UTC
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    db.session.execute(IndicatorRankingState.__table__.insert(), [{
+        'indicator_id': indicator.id,
+        'computed_from': indicator.last_update,
+        'computed_at': now,
+        'rankings': counts[indicator.id],
+    } for indicator in indicators])
+    return len(records)
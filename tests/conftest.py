@@ -0,0 +1,62 @@
+"""
+The models import 'db' from the 'app' module of the application embedding
+this package. The tests provide one backed by an in-memory SQLite database
+and import the package as 'landportal_model'. Test modules skip themselves
+with pytest.importorskip when their dependencies are missing.
+"""
+import importlib.util
+import os
+import sys
+import types
+
+import pytest
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import flask
+    import flask_sqlalchemy
+except ImportError:
+    pass
+else:
+    if 'app' not in sys.modules:
+        app_module = types.ModuleType('app')
+        app_module.app = flask.Flask('landportal_model_tests')
+        app_module.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app_module.db = flask_sqlalchemy.SQLAlchemy(app_module.app)
+        sys.modules['app'] = app_module
+
+    if 'landportal_model' not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            'landportal_model', os.path.join(PACKAGE_DIR, '__init__.py'),
+            submodule_search_locations=[PACKAGE_DIR])
+        sys.modules['landportal_model'] = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(sys.modules['landportal_model'])
+
+
+@pytest.fixture
+def db():
+    from app import app, db
+    import landportal_model.models  # registers the tables
+    with app.app_context():
+        db.create_all()
+        yield db
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def make_observation(db):
+    """Returns a factory of observations of a country, with a numeric or
+    textual value"""
+    from landportal_model.models import Observation, Value
+
+    def make_observation(id, indicator, country, year, value, dataset=None):
+        observation_value = Value()
+        observation_value.value = value
+        observation = Observation(id, ref_time=year, value=observation_value,
+                                  indicator=indicator)
+        observation.region_id = country.id
+        observation.dataset = dataset
+        return observation
+    return make_observation
@@ -0,0 +1,114 @@
+import pytest
+
+pytest.importorskip('flask_sqlalchemy')
+
+from landportal_model import auth
+from landportal_model.models import Auth
+
+
+@pytest.fixture
+def user(db):
+    user = Auth('u1', 'secret')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def _delete_behind_the_session(db, user):
+    """Deletes the row without the session noticing, as a bulk delete"""
+    Auth.query.filter_by(user=user).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def test_only_the_digest_is_stored(db, user):
+    row = db.session.query(Auth.__table__).one()
+    assert row.token is None
+    assert row.token_digest == Auth.digest('secret')
+
+
+def test_verify_hit_and_miss(db, user):
+    verifier = auth.TokenVerifier()
+    assert verifier.verify('secret') == 'u1'
+    assert verifier.verify('other') is None
+    assert verifier.verify('') is None
+    assert verifier.verify(None) is None
+
+    # Bulk operations are not noticed: the cached token keeps being valid
+    _delete_behind_the_session(db, 'u1')
+    assert verifier.verify('secret') == 'u1'
+
+
+def test_rotation_invalidates_the_old_token_on_commit(db, user):
+    verifier = auth.TokenVerifier()
+    assert verifier.verify('secret') == 'u1'
+    user.token = 'other'
+    db.session.flush()
+    assert Auth.digest('secret') in verifier._cache
+    db.session.commit()
+    assert verifier.verify('secret') is None
+    assert verifier.verify('other') == 'u1'
+
+
+@pytest.mark.parametrize('revoke', [lambda user: user.revoke(),
+                                    lambda user: setattr(user, 'token', None)])
+def test_revocation(db, user, revoke):
+    verifier = auth.TokenVerifier()
+    assert verifier.verify('secret') == 'u1'
+    revoke(user)
+    db.session.commit()
+    assert verifier.verify('secret') is None
+    assert db.session.query(Auth.token_digest).scalar() is None
+
+
+def test_delete(db, user):
+    verifier = auth.TokenVerifier()
+    assert verifier.verify('secret') == 'u1'
+    db.session.delete(user)
+    db.session.commit()
+    assert verifier.verify('secret') is None
+
+
+def test_rollback_keeps_the_cache(db, user):
+    verifier = auth.TokenVerifier()
+    assert verifier.verify('secret') == 'u1'
+    user.token = 'other'
+    db.session.flush()
+    db.session.rollback()
+    db.session.commit()
+    assert Auth.digest('secret') in verifier._cache
+    assert verifier.verify('secret') == 'u1'
+
+
+def test_cached_tokens_expire(db, user, monkeypatch):
+    verifier = auth.TokenVerifier(ttl=10)
+    now = auth.time.time()
+    monkeypatch.setattr(auth.time, 'time', lambda: now)
+    assert verifier.verify('secret') == 'u1'
+    _delete_behind_the_session(db, 'u1')
+    monkeypatch.setattr(auth.time, 'time', lambda: now + 9)
+    assert verifier.verify('secret') == 'u1'
+    monkeypatch.setattr(auth.time, 'time', lambda: now + 10)
+    assert verifier.verify('secret') is None
+
+
+def test_cache_is_bounded(db):
+    db.session.add_all([Auth('u%d' % i, 'token%d' % i) for i in range(3)])
+    db.session.commit()
+    verifier = auth.TokenVerifier(max_size=2)
+    for i in range(3):
+        assert verifier.verify('token%d' % i) == 'u%d' % i
+    assert list(verifier._cache) == [Auth.digest('token1'), Auth.digest('token2')]
+
+
+def test_backfill_token_digests(db):
+    db.session.execute(Auth.__table__.insert(), [{'user': 'u1', 'token': 'secret'},
+                                                 {'user': 'u2', 'token': None}])
+    db.session.commit()
+    verifier = auth.TokenVerifier()
+    assert verifier.verify('secret') is None
+
+    assert auth.backfill_token_digests() == 1
+    assert verifier.verify('secret') == 'u1'
+    assert db.session.query(Auth.__table__.c.token).filter(
+        Auth.__table__.c.token != None).count() == 0
+    assert auth.backfill_token_digests() == 0
@@ -0,0 +1,97 @@
+import pytest
+
+pytest.importorskip('flask_sqlalchemy')
+
+from landportal_model import catalog
+from landportal_model.models import DataSource, Dataset, Indicator, IndicatorTranslation, \
+    Language, Organization, OrganizationTranslation
+
+
+@pytest.fixture
+def organization(db):
+    db.session.add_all([Language('English', 'en'), Language('Spanish', 'es')])
+    organization = Organization('o1', 'FAO')
+    organization.add_translation(OrganizationTranslation('en', 'Food and Agriculture'))
+    source = DataSource('FAOSTAT', dsource_id='s1')
+    source.organization = organization
+    dataset = Dataset('d1')
+    dataset.datasource = source
+    indicators = [Indicator('i2'), Indicator('i1', 'increase')]
+    indicators[1].add_translation(IndicatorTranslation('en', 'Land area', 'Hectares'))
+    indicators[1].add_translation(IndicatorTranslation('es', 'Superficie', 'Hectareas'))
+    dataset.indicators.extend(indicators)
+    # Neither attached to an organization nor to a source
+    orphan_source = DataSource('Unknown', dsource_id='s2')
+    orphan_dataset = Dataset('d2')
+    db.session.add_all([organization, source, dataset, orphan_source, orphan_dataset]
+                       + indicators)
+    db.session.commit()
+    return organization
+
+
+def test_build_snapshot(db, organization):
+    snapshot = catalog.build_snapshot('en')
+    assert snapshot.lang_code == 'en'
+    fao, = snapshot.organizations
+    assert (fao.id, fao.name, fao.description) == ('o1', 'FAO', 'Food and Agriculture')
+    source, = fao.sources
+    dataset, = source.datasets
+    assert dataset.id == 'd1'
+    assert [indicator.id for indicator in dataset.indicators] == ['i1', 'i2']
+    assert dataset.indicators[0].name == 'Land area'
+    assert dataset.indicators[0].preferable_tendency == 'increase'
+    assert dataset.indicators[1].name is None
+
+    assert catalog.build_snapshot('es').organizations[0].sources[0].datasets[0] \
+        .indicators[0].name == 'Superficie'
+
+
+def test_unassigned_sources_and_datasets_are_kept(db, organization):
+    snapshot = catalog.build_snapshot('en')
+    assert [source.id for source in snapshot.unassigned_sources] == ['s2']
+    assert [dataset.id for dataset in snapshot.unassigned_datasets] == ['d2']
+    content = snapshot.to_dict()
+    assert content['unassigned_sources'][0]['id'] == 's2'
+    assert content['version'] == snapshot.version
+
+
+def test_matches(db, organization):
+    snapshot = catalog.build_snapshot('en')
+    assert snapshot.matches(snapshot.etag)
+    assert snapshot.matches('W/' + snapshot.etag)
+    assert snapshot.matches('"other", %s' % snapshot.etag)
+    assert snapshot.matches('*')
+    assert not snapshot.matches('"other"')
+    assert not snapshot.matches('')
+    assert not snapshot.matches(None)
+
+
+def test_etag_follows_contents(db, organization):
+    etag = catalog.build_snapshot('en').etag
+    assert catalog.build_snapshot('en').etag == etag
+    assert catalog.build_snapshot('es').etag != etag
+
+    organization.translations[0].description = 'FAO'
+    db.session.commit()
+    assert catalog.build_snapshot('en').etag != etag
+
+
+def test_cache_refresh(db, organization):
+    from app import app
+    cache = catalog.CatalogCache(app)
+    snapshot = cache.get('en')
+    assert cache.get('en') is snapshot
+
+    cache.refresh_async().join()
+    assert cache.get('en').etag == snapshot.etag
+
+    organization.name = 'Food and Agriculture Organization'
+    db.session.commit()
+    cache.refresh_async().join()
+    assert cache.get('en').organizations[0].name == 'Food and Agriculture Organization'
+    assert not cache.get('en').matches(snapshot.etag)
+
+
+def test_refresh_async_needs_an_app(db, organization):
+    with pytest.raises(ValueError):
+        catalog.CatalogCache().refresh_async()
@@ -0,0 +1,102 @@
+import pytest
+
+pytest.importorskip('flask_sqlalchemy')
+np = pytest.importorskip('numpy')
+
+from landportal_model import cube
+from landportal_model.models import Country, Dataset, Indicator, Observation, YearInterval
+
+
+@pytest.fixture
+def catalog(db, make_observation):
+    countries = [Country(iso3='AAA'), Country(iso3='BBB'), Country()]
+    years = [YearInterval(2000), YearInterval(2001)]
+    indicators = [Indicator('i1'), Indicator('i2')]
+    datasets = [Dataset('d1'), Dataset('d2')]
+    db.session.add_all(countries + years + indicators + datasets)
+    db.session.flush()
+    db.session.add_all([
+        make_observation('o1', indicators[0], countries[0], years[0], '1.5', datasets[0]),
+        make_observation('o2', indicators[0], countries[1], years[1], '2', datasets[0]),
+        make_observation('o3', indicators[1], countries[0], years[1], '3', datasets[1]),
+        # Observations outside any dataset are exported as well
+        make_observation('o4', indicators[1], countries[1], years[0], '4'),
+        make_observation('o5', indicators[1], countries[2], years[0], '5', datasets[1]),
+        make_observation('o8', indicators[0], countries[2], years[1], 'n/a', datasets[0]),
+    ])
+    db.session.commit()
+    return countries, years, indicators, datasets
+
+
+def _assert_same_cube(actual, expected):
+    assert actual.indicators == expected.indicators
+    assert actual.regions == expected.regions
+    assert actual.periods == expected.periods
+    assert actual.datasets == expected.datasets
+    np.testing.assert_array_equal(np.asarray(actual.data), np.asarray(expected.data))
+
+
+def test_export_and_open(db, catalog, tmp_path):
+    countries, _, _, _ = catalog
+    path = str(tmp_path / 'observations.cube')
+    cube.export_cube(path)
+
+    observations = cube.ObservationCube.open(path, verify=True)
+    assert observations.version == 1
+    assert observations.indicators == ['i1', 'i2']
+    assert observations.periods == [2000, 2001]
+    assert observations.datasets == {'d1': ['i1'], 'd2': ['i2']}
+    assert isinstance(observations.data, np.memmap)
+    assert observations.value('i1', countries[0].id, 2000) == 1.5
+    assert observations.value('i2', countries[1].id, 2000) == 4.0
+    assert np.isnan(observations.value('i1', countries[0].id, 2001))
+    assert np.isnan(observations.value('i1', countries[2].id, 2001))
+    assert observations.country('AAA')[1, 1] == 3.0
+    assert observations.indicator('i1').shape == (3, 2)
+
+
+def test_update_matches_a_full_export(db, catalog, make_observation, tmp_path):
+    countries, years, indicators, datasets = catalog
+    # Two datasets observing the same cell: the greatest observation id wins
+    db.session.add_all([
+        make_observation('dup_a', indicators[1], countries[1], years[1], '1', datasets[0]),
+        make_observation('dup_b', indicators[1], countries[1], years[1], '2', datasets[1]),
+    ])
+    db.session.commit()
+    path = str(tmp_path / 'observations.cube')
+    cube.export_cube(path)
+    assert cube.ObservationCube.open(path).value('i2', countries[1].id, 2001) == 2.0
+
+    countries[2].iso3 = 'CCC'
+    db.session.get(Observation, 'o3').value.value = '30'
+    i3 = Indicator('i3')
+    db.session.add_all([
+        i3,
+        make_observation('o6', i3, countries[2], years[1], '6', datasets[1]),
+        make_observation('o7', indicators[1], countries[2], years[1], '7', datasets[1]),
+    ])
+    db.session.commit()
+
+    cube.update_cube(path, ['d2'])
+    updated = cube.ObservationCube.open(path, verify=True)
+    assert updated.version == 2
+    assert updated.value('i2', countries[0].id, 2001) == 30.0
+    assert updated.value('i2', countries[1].id, 2000) == 4.0
+    assert updated.country('CCC')[2, 1] == 6.0
+    assert updated.value('i2', countries[2].id, 2000) == 5.0
+    assert updated.value('i2', countries[1].id, 2001) == 2.0
+    assert len(updated.regions) == 3
+
+    expected_path = str(tmp_path / 'expected.cube')
+    cube.export_cube(expected_path)
+    _assert_same_cube(updated, cube.ObservationCube.open(expected_path))
+
+
+def test_verify_detects_corrupted_header(db, catalog, tmp_path):
+    path = str(tmp_path / 'observations.cube')
+    cube.export_cube(path)
+    with open(path, 'r+b') as cube_file:
+        cube_file.seek(cube.HEADER.size - 4)
+        cube_file.write(b'\x01\x00\x00\x00')
+    with pytest.raises(cube.CubeFormatError):
+        cube.ObservationCube.open(path, verify=True)
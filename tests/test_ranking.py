@@ -0,0 +1,88 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('flask_sqlalchemy')
+pytest.importorskip('numpy')
+
+from landportal_model import ranking
+from landportal_model.models import Country, Indicator, IndicatorRanking, \
+    IndicatorRankingState, YearInterval
+
+
+def test_ties_share_the_best_rank_when_higher_is_better():
+    ranks, percentiles, z_scores = ranking.compute_rankings(
+        [0, 0, 0, 0], [2000] * 4, [5.0, 7.0, 7.0, 1.0], [False])
+    assert ranks.tolist() == [3, 1, 1, 4]
+    assert percentiles.tolist() == pytest.approx([100.0 / 3, 100.0, 100.0, 0.0])
+    assert z_scores[1] > 0 and z_scores[3] < 0
+    assert z_scores[1] == z_scores[2]
+
+
+def test_ties_share_the_best_rank_when_lower_is_better():
+    ranks, percentiles, z_scores = ranking.compute_rankings(
+        [0, 0, 0, 0], [2000] * 4, [5.0, 7.0, 7.0, 1.0], [True])
+    assert ranks.tolist() == [2, 3, 3, 1]
+    assert percentiles.tolist() == pytest.approx([200.0 / 3, 100.0 / 3, 100.0 / 3, 100.0])
+    assert z_scores[3] > 0 and z_scores[1] < 0
+
+
+def test_groups_are_ranked_separately():
+    ranks, percentiles, z_scores = ranking.compute_rankings(
+        [0, 1, 0, 1, 0], [2000, 2000, 2000, 2000, 2001], [1.0, 1.0, 2.0, 2.0, 9.0],
+        [False, True])
+    assert ranks.tolist() == [2, 1, 1, 2, 1]
+    assert percentiles.tolist() == [0.0, 100.0, 100.0, 0.0, 100.0]
+    # A single value has no spread
+    assert z_scores[4] == 0.0
+
+
+@pytest.fixture
+def catalog(db, make_observation):
+    countries = [Country(iso3=iso3) for iso3 in ('AAA', 'BBB', 'CCC')]
+    year = YearInterval(2000)
+    up = Indicator('up', 'increase')
+    down = Indicator('down', 'decrease')
+    empty = Indicator('empty')
+    up.last_update = down.last_update = empty.last_update = datetime.datetime(2020, 1, 1)
+    db.session.add_all(countries + [year, up, down, empty])
+    db.session.flush()
+    for i, (country, value) in enumerate(zip(countries, ['1', '5', 'n/a'])):
+        db.session.add(make_observation('up%d' % i, up, country, year, value))
+        db.session.add(make_observation('down%d' % i, down, country, year, value))
+    # Duplicate of up0: the observation with the greatest id wins
+    db.session.add(make_observation('up9', up, countries[0], year, '9'))
+    db.session.commit()
+    return countries, up
+
+
+def test_update_rankings_writes_single_row_lookups(db, catalog):
+    countries, _ = catalog
+    assert ranking.update_rankings() == 4
+    best = ranking.get_ranking('up', 2000, countries[0].id)
+    assert (best.value, best.rank, best.percentile) == (9.0, 1, 100.0)
+    best = ranking.get_ranking('down', 2000, countries[0].id)
+    assert (best.value, best.rank) == (1.0, 1)
+    assert ranking.get_ranking('up', 2000, countries[2].id) is None
+
+
+def test_only_updated_indicators_are_stale(db, catalog):
+    _, up = catalog
+    assert sorted(ranking.stale_indicators()) == ['down', 'empty', 'up']
+    ranking.update_rankings()
+    assert ranking.stale_indicators() == []
+    assert db.session.get(IndicatorRankingState, 'empty').rankings == 0
+
+    up.last_update = datetime.datetime(2021, 1, 1)
+    db.session.commit()
+    assert ranking.stale_indicators() == ['up']
+    ranking.update_rankings()
+    assert IndicatorRanking.query.filter_by(indicator_id='up').count() == 2
+
+
+def test_indicators_without_last_update_are_always_stale(db, catalog):
+    _, up = catalog
+    up.last_update = None
+    db.session.commit()
+    ranking.update_rankings()
+    assert ranking.stale_indicators() == ['up']